@@ -0,0 +1,53 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import gzip
+import json
+
+from os import walk
+from os.path import abspath, dirname, join, relpath
+
+from pio_source_manifest import (MANIFEST_NAME, MANIFEST_VERSION, SKIP_DIRS,
+                                 get_package_state)
+
+pio_tools = dirname(abspath(__file__))
+framework_dir = dirname(pio_tools)
+
+
+def build_manifest():
+    dirs = {}
+    for root, subdirs, files in walk(framework_dir):
+        if root == framework_dir:
+            subdirs[:] = [d for d in subdirs if d not in SKIP_DIRS]
+        subdirs.sort()
+        key = relpath(root, framework_dir).replace("\\", "/")
+        if key == ".":
+            key = ""
+        dirs[key] = {
+            "dirs": subdirs[:],
+            "files": sorted(files),
+        }
+
+    manifest_path = join(pio_tools, MANIFEST_NAME)
+    with gzip.open(manifest_path, "wt") as fp:
+        json.dump({
+            "version": MANIFEST_VERSION,
+            "package": get_package_state(framework_dir),
+            "dirs": dirs,
+        }, fp, separators=(",", ":"))
+    print("Source manifest with %d folders saved to %s" % (len(dirs), manifest_path))
+
+
+build_manifest()
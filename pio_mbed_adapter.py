@@ -23,6 +23,7 @@ from os.path import (abspath, basename, isfile, join, relpath,
 from tools.build_api import prepare_toolchain, UPDATE_WHITELIST
 
 from tools.regions import merge_region_list
+from tools.resources import FileType
 from tools.targets import TARGET_MAP, Target, update_target_data
 from tools.utils import generate_update_filename
 
@@ -50,7 +51,8 @@ class PlatformioMbedAdapter(object):
                  build_profile=BUILD_PROFILE,
                  custom_target_path=None,
                  toolchain_name=TOOLCHAIN_NAME,
-                 ignore_dirs=None):
+                 ignore_dirs=None,
+                 project_dir=None):
         self.src_paths = src_paths
         self.build_path = build_path
         self.target = target
@@ -63,6 +65,7 @@ class PlatformioMbedAdapter(object):
         self.resources = None
         self.notify = get_notifier()
         self.custom_target_path = custom_target_path
+        self.project_dir = project_dir
 
     def get_build_profile(self):
         file_with_profiles = join(self.framework_path, "tools", "profiles",
@@ -199,24 +202,22 @@ class PlatformioMbedAdapter(object):
             self.src_paths, self.toolchain, dependencies_paths, inc_dirs=inc_dirs
         )
 
-        src_files = (
-            self.resources.s_sources
-            + self.resources.c_sources
-            + self.resources.cpp_sources
-        )
-
-        project_dir = backup_cwd
+        project_dir = self.project_dir or backup_cwd
         ignorefile = join(project_dir, ".mbedignore")
+        ignoreset = None
         if os.path.isfile(ignorefile):
             # Exclude sources according to ignore patterns loaded from .mbedignore
             ignoreset = MbedIgnoreSetFixedPath()
             ignoreset.add_mbedignore(".", ignorefile)
 
-            src_files = [
-                file
-                for file in src_files
-                if not ignoreset.is_ignored(file)
-            ]
+        # Sources are fixed and filtered in a single pass, only the sorted
+        # list of each file type is built, not the concatenated copies
+        src_files = [
+            file
+            for file in self.resources.iter_file_paths(
+                FileType.ASM_SRC, FileType.C_SRC, FileType.CPP_SRC)
+            if not ignoreset or not ignoreset.is_ignored(file)
+        ]
 
         if generate_config:
             self.generate_mbed_config_file()
@@ -0,0 +1,311 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Long-lived process that keeps the mbed build API warm between builds.
+
+Start it with:
+
+    python <framework-mbed>/platformio/pio_mbed_daemon.py
+
+The target database, scanned resources and toolchain objects stay in memory
+and are reused while the framework and project files are unchanged. The
+builder script talks to the daemon over a Unix socket and silently falls
+back to the in-process path when the daemon is not running.
+"""
+
+import hashlib
+import json
+import os
+import socket
+import stat
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+
+from os.path import abspath, dirname, expanduser, getmtime, isdir, isfile, join
+
+# How often the framework tree is checked for changes, in seconds
+POLL_INTERVAL = 5
+# The daemon exits if no requests arrive within this period, in seconds
+IDLE_TIMEOUT = 3600
+CLIENT_TIMEOUT = 60
+# Each cached entry keeps the toolchain and scanned resources in memory
+MAX_CACHE_ENTRIES = 4
+
+# Files in the project folder that affect the configuration
+PROJECT_FILES = ("mbed_app.json", ".mbedignore", "custom_targets.json")
+
+
+def get_socket_dir():
+    # Sockets live in a private per-user folder, so other local users
+    # can't bind the path first and impersonate the daemon
+    return join(
+        os.environ.get("XDG_RUNTIME_DIR") or join(expanduser("~"), ".platformio"),
+        "mbed-daemon",
+    )
+
+
+def get_socket_path(framework_path):
+    return join(
+        get_socket_dir(),
+        "%s.sock" % hashlib.md5(abspath(framework_path).encode()).hexdigest()[:10],
+    )
+
+
+def is_owned_by_user(path):
+    info = os.stat(path)
+    return info.st_uid == os.getuid() and not (
+        info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+    )
+
+
+def has_custom_targets(params):
+    return bool(params.get("custom_target_path")) and isfile(
+        join(params["custom_target_path"], "custom_targets.json")
+    )
+
+
+def is_supported():
+    return hasattr(socket, "AF_UNIX")
+
+
+def _send_message(conn, data):
+    conn.sendall(json.dumps(data).encode() + b"\n")
+
+
+def _recv_message(conn):
+    chunks = []
+    while True:
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if chunk.endswith(b"\n"):
+            break
+    return json.loads(b"".join(chunks).decode())
+
+
+def request_project_info(framework_path, params, generate_config=False):
+    """Ask a running daemon for the result of `extract_project_info`.
+
+    Returns None if the daemon is not available or failed to process the
+    request, so the caller can run the mbed build API in-process.
+    """
+    # Custom targets modify the global target database of the mbed build
+    # API, such projects are always processed in-process
+    if has_custom_targets(params):
+        return None
+    socket_path = get_socket_path(framework_path)
+    if not is_supported() or not os.path.exists(socket_path):
+        return None
+    try:
+        if not is_owned_by_user(dirname(socket_path)) or not is_owned_by_user(
+            socket_path
+        ):
+            return None
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.settimeout(CLIENT_TIMEOUT)
+        conn.connect(socket_path)
+        try:
+            _send_message(
+                conn, {"params": params, "generate_config": generate_config}
+            )
+            response = _recv_message(conn)
+        finally:
+            conn.close()
+    except (OSError, ValueError):
+        return None
+    return response.get("result")
+
+
+class FrameworkWatcher(threading.Thread):
+    """Polls timestamps of framework folders and configuration files.
+
+    The tree is walked once, afterwards only the known paths are checked
+    and just the changed folders are walked again. `generation` is
+    incremented on every detected change.
+    """
+
+    def __init__(self, framework_path):
+        super(FrameworkWatcher, self).__init__()
+        self.daemon = True
+        self.framework_path = framework_path
+        self.generation = 0
+        self.mtimes = {}
+        self.scan(framework_path)
+
+    def scan(self, path):
+        # Adding or removing files updates the directory timestamp, while
+        # the configuration is affected only by JSON files
+        for root, dirs, files in os.walk(path):
+            if root == self.framework_path and "platformio" in dirs:
+                dirs.remove("platformio")
+            self.mtimes[root] = getmtime(root)
+            for name in files:
+                if name.endswith(".json") or name == ".mbedignore":
+                    self.mtimes[join(root, name)] = getmtime(join(root, name))
+
+    def forget(self, path):
+        prefix = join(path, "")
+        for known in list(self.mtimes):
+            if known == path or known.startswith(prefix):
+                del self.mtimes[known]
+
+    def poll(self):
+        changed = []
+        for path, mtime in list(self.mtimes.items()):
+            try:
+                if getmtime(path) != mtime:
+                    changed.append(path)
+            except OSError:
+                changed.append(path)
+        for path in changed:
+            self.forget(path)
+            if isdir(path):
+                self.scan(path)
+        if changed:
+            self.generation += 1
+
+    def run(self):
+        while True:
+            time.sleep(POLL_INTERVAL)
+            try:
+                self.poll()
+            except OSError:
+                # A file was removed during the scan, try again later
+                self.generation += 1
+
+
+class PlatformioMbedDaemon(object):
+    def __init__(self, framework_path):
+        self.framework_path = framework_path
+        self.watcher = FrameworkWatcher(framework_path)
+        self.cache = OrderedDict()
+        self.manifest_generation = None
+
+    def get_project_signature(self, project_dir):
+        result = []
+        for name in PROJECT_FILES:
+            path = join(project_dir or "", name)
+            result.append(getmtime(path) if isfile(path) else None)
+        return result
+
+    def process_request(self, request):
+        from pio_mbed_adapter import PlatformioMbedAdapter
+        from pio_resources_fixed_path import reset_source_manifests
+
+        params = request["params"]
+        if has_custom_targets(params):
+            raise ValueError("Projects with custom targets are not supported")
+        key = json.dumps(params, sort_keys=True)
+        signature = [
+            self.watcher.generation,
+            self.get_project_signature(params.get("project_dir")),
+        ]
+
+        cached = self.cache.pop(key, None)
+        if cached and cached[0] == signature:
+            adapter, result = cached[1], cached[2]
+        else:
+            if self.manifest_generation != self.watcher.generation:
+                reset_source_manifests()
+                self.manifest_generation = self.watcher.generation
+            adapter = PlatformioMbedAdapter(**params)
+            result = adapter.extract_project_info()
+        # Least recently used entries are evicted first
+        self.cache[key] = (signature, adapter, result)
+        while len(self.cache) > MAX_CACHE_ENTRIES:
+            self.cache.popitem(last=False)
+
+        if request.get("generate_config"):
+            backup_cwd = os.getcwd()
+            os.chdir(self.framework_path)
+            try:
+                if not isdir(adapter.build_path):
+                    os.makedirs(adapter.build_path)
+                adapter.generate_mbed_config_file()
+            finally:
+                os.chdir(backup_cwd)
+
+        return result
+
+    def handle_connection(self, conn):
+        # A stalled or disconnected client must not block or stop the daemon
+        conn.settimeout(CLIENT_TIMEOUT)
+        try:
+            request = _recv_message(conn)
+            try:
+                response = {"result": self.process_request(request)}
+            except (Exception, SystemExit) as exc:
+                response = {"error": str(exc)}
+            _send_message(conn, response)
+        except (OSError, ValueError):
+            pass
+        finally:
+            conn.close()
+
+    def serve_forever(self):
+        socket_path = get_socket_path(self.framework_path)
+        if not isdir(get_socket_dir()):
+            os.makedirs(get_socket_dir(), mode=0o700)
+        os.chmod(get_socket_dir(), 0o700)
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(socket_path)
+        server.listen(5)
+        server.settimeout(IDLE_TIMEOUT)
+        self.watcher.start()
+        print("Listening on %s" % socket_path)
+        try:
+            while True:
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    break
+                self.handle_connection(conn)
+        finally:
+            server.close()
+            os.remove(socket_path)
+
+
+def main():
+    if not is_supported():
+        sys.stderr.write("Unix sockets are not supported on this platform\n")
+        sys.exit(1)
+
+    pio_tools = dirname(abspath(__file__))
+    framework_path = sys.argv[1] if len(sys.argv) > 1 else dirname(pio_tools)
+
+    # The same search path as in platformio-build.py
+    sys.path.insert(
+        0,
+        join(
+            pio_tools,
+            "package_deps",
+            "py%d%s"
+            % (sys.version_info.major, "_old" if sys.version_info < (3, 9) else ""),
+        ),
+    )
+    sys.path.insert(1, framework_path)
+    sys.path.insert(2, pio_tools)
+
+    PlatformioMbedDaemon(framework_path).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -14,8 +14,26 @@
 
 from os.path import basename, join
 
+import tools.resources
 from tools.resources import Resources, MbedIgnoreSet
 
+from pio_source_manifest import SourceManifest
+
+# Manifests loaded in this process, per framework path. False marks
+# a missing or rejected manifest, so it isn't loaded again
+_manifests = {}
+
+
+def get_source_manifest(framework_path):
+    if framework_path not in _manifests:
+        _manifests[framework_path] = SourceManifest.load(framework_path) or False
+    return _manifests[framework_path] or None
+
+
+def reset_source_manifests():
+    # Used by long-lived processes when the framework has changed
+    _manifests.clear()
+
 
 class MbedResourcesFixedPath(Resources):
 
@@ -23,9 +41,33 @@ class MbedResourcesFixedPath(Resources):
         super(MbedResourcesFixedPath, self).__init__(notify, collect_ignores)
         self.framework_path = framework_path
 
+    def add_directory(self, path, *args, **kwargs):
+        # Label, feature and toolchain filtering is still done by the build
+        # API, only the directory listing comes from the precomputed manifest
+        manifest = get_source_manifest(self.framework_path)
+        if not manifest or not hasattr(tools.resources, "walk"):
+            return super(MbedResourcesFixedPath, self).add_directory(
+                path, *args, **kwargs)
+
+        original_walk = tools.resources.walk
+        tools.resources.walk = manifest.walk
+        try:
+            return super(MbedResourcesFixedPath, self).add_directory(
+                path, *args, **kwargs)
+        finally:
+            tools.resources.walk = original_walk
+
     def get_file_paths(self, file_type):
         return self.fix_paths(self._get_from_refs(file_type, lambda f: f.path))
 
+    def iter_file_paths(self, *file_types):
+        # Same order and values as concatenated "get_file_paths" results
+        for file_type in file_types:
+            for path in sorted(f.path for f in self.get_file_refs(file_type)):
+                path = self.fix_path(path)
+                if path:
+                    yield path
+
     def fix_path(self, path):
         # mbed build api provides the relative path with two
         # redundant directories, so they are removed
@@ -0,0 +1,93 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import gzip
+import hashlib
+import json
+import os
+
+from os.path import abspath, isdir, isfile, join, normpath, relpath
+
+MANIFEST_NAME = "source_manifest.json.gz"
+MANIFEST_VERSION = 3
+
+# Folders that never contain framework sources
+SKIP_DIRS = (".git", ".github", "platformio")
+
+
+def get_package_state(framework_path):
+    """Identifies the framework package, survives packing and unpacking"""
+    package_json = join(framework_path, "package.json")
+    if not isfile(package_json):
+        return None
+    with open(package_json, "rb") as fp:
+        contents = fp.read()
+    return {
+        "version": json.loads(contents.decode()).get("version"),
+        "hash": hashlib.sha1(contents).hexdigest(),
+    }
+
+
+class SourceManifest(object):
+    """Directory tree of the framework precomputed at package build time.
+
+    `walk` has the same semantics as `os.walk` (including pruning of
+    `dirs` in place) but is served from memory for folders inside
+    the framework.
+    """
+
+    def __init__(self, framework_path, dirs):
+        self.framework_path = abspath(framework_path)
+        self.dirs = dirs
+
+    @classmethod
+    def load(cls, framework_path):
+        manifest_path = join(framework_path, "platformio", MANIFEST_NAME)
+        # Files in a development checkout change without a new package
+        # version, such trees are always scanned from the filesystem
+        if not isfile(manifest_path) or isdir(join(framework_path, ".git")):
+            return None
+        with gzip.open(manifest_path, "rt") as fp:
+            data = json.load(fp)
+        if (
+            data.get("version") != MANIFEST_VERSION
+            or data.get("package") != get_package_state(framework_path)
+        ):
+            return None
+        return cls(framework_path, data["dirs"])
+
+    def get_key(self, path):
+        key = relpath(normpath(abspath(path)), self.framework_path)
+        if key == ".":
+            return ""
+        return key.replace(os.sep, "/")
+
+    def walk(self, top, topdown=True, onerror=None, followlinks=False):
+        key = self.get_key(top)
+        if not topdown or key not in self.dirs:
+            for item in os.walk(top, topdown, onerror, followlinks):
+                yield item
+            return
+
+        stack = [(top, key)]
+        while stack:
+            root, key = stack.pop()
+            entry = self.dirs.get(key)
+            if entry is None:
+                continue
+            dirs = list(entry["dirs"])
+            yield root, dirs, list(entry["files"])
+            for d in reversed(dirs):
+                stack.append((join(root, d), "%s/%s" % (key, d) if key else d))
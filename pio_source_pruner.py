@@ -0,0 +1,338 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import fnmatch
+import hashlib
+import json
+import os
+import re
+import subprocess
+
+from os.path import getmtime, isfile, join, splitext
+
+# Framework folders that are always compiled: startup code, the RTOS kernel
+# and the platform layer (retarget, boot sequence, error handling)
+ROOT_FOLDERS = ("cmsis", "platform", "rtos")
+
+# Symbols the linker pulls in on its own (vector table, entry point)
+ROOT_SYMBOLS = ("Reset_Handler", "SystemInit", "main")
+
+# Sections with C/C++ constructors and destructors, they are kept by
+# the linker even if nothing references them
+CTOR_SECTIONS = (".init_array*", ".preinit_array*", ".fini_array*",
+                 ".ctors*", ".dtors*")
+
+# Number of object files passed to a single `nm`/`objdump` call
+NM_BATCH_SIZE = 200
+
+INDEX_VERSION = 2
+
+
+def get_config_hash(configuration, target, keep_patterns):
+    data = json.dumps(
+        [
+            target,
+            configuration.get("build_symbols"),
+            configuration.get("build_flags"),
+            keep_patterns,
+        ],
+        sort_keys=True,
+    )
+    return hashlib.md5(data.encode()).hexdigest()
+
+
+def get_keep_patterns(ldscript):
+    """Section patterns wrapped with KEEP(...) in the linker script"""
+    patterns = set(CTOR_SECTIONS)
+    if not ldscript or not isfile(ldscript):
+        return sorted(patterns)
+    with open(ldscript) as fp:
+        contents = fp.read()
+    for match in re.finditer(r"KEEP\s*\(", contents):
+        depth, end = 1, match.end()
+        while depth and end < len(contents):
+            depth += {"(": 1, ")": -1}.get(contents[end], 0)
+            end += 1
+        # e.g. "*(SORT(.init_array.*))" or "*crtbegin.o(.ctors)"
+        patterns.update(
+            re.findall(r"(?:^|[\s(])(\.[^\s()]+)", contents[match.end():end - 1])
+        )
+    return sorted(patterns)
+
+
+def get_object_path(build_dir, src_file):
+    # Mirrors the layout produced by "env.BuildSources" in platformio-build.py
+    parts = src_file.split(os.path.sep)
+    return join(
+        build_dir, "FrameworkMbed" + parts[0], *(parts[1:-1] + [
+            splitext(parts[-1])[0] + ".o"
+        ])
+    )
+
+
+def get_newest_mtime(paths):
+    result = 0
+    for path in paths:
+        for root, _, files in os.walk(path):
+            for name in files:
+                result = max(result, getmtime(join(root, name)))
+    return result
+
+
+def get_wrapped_symbols(link_flags):
+    # e.g. "-Wl,--wrap,main" makes the linker look for "__wrap_main"
+    result = []
+    for flag in link_flags:
+        if "--wrap," not in flag:
+            continue
+        result.append("__wrap_" + flag.split("--wrap,")[-1])
+    return result
+
+
+def read_symbols(nm_cmd, obj_files):
+    """Run `nm` over object files or archives and group symbols per file:
+
+    defined - strong global definitions
+    weak - weak definitions that a strong symbol may override
+    undefined - external references (weak references included)
+    ctor - the file has static constructors and is kept by the linker
+    """
+    result = {}
+    for i in range(0, len(obj_files), NM_BATCH_SIZE):
+        batch = obj_files[i:i + NM_BATCH_SIZE]
+        for obj in batch:
+            result[obj] = {
+                "defined": [], "weak": [], "undefined": [], "ctor": False
+            }
+        output = subprocess.check_output(
+            [nm_cmd, "-A", "-P"] + batch, universal_newlines=True
+        )
+        for line in output.splitlines():
+            if ": " not in line:
+                continue
+            obj, data = line.rsplit(": ", 1)
+            if obj not in result and obj.endswith("]") and "[" in obj:
+                # Archive members are reported as "libname.a[member.o]"
+                obj = obj[:obj.rindex("[")]
+            fields = data.split()
+            if obj not in result or len(fields) < 2:
+                continue
+            name, kind = fields[0], fields[1]
+            entry = result[obj]
+            if name.startswith("_GLOBAL__sub_I_"):
+                entry["ctor"] = True
+            elif kind in ("U", "w", "v"):
+                entry["undefined"].append(name)
+            elif kind in ("W", "V"):
+                entry["weak"].append(name)
+            elif kind.isupper():
+                entry["defined"].append(name)
+    return result
+
+
+def read_sections(objdump_cmd, obj_files):
+    """Run `objdump -h` over object files and collect section names"""
+    result = {}
+    for i in range(0, len(obj_files), NM_BATCH_SIZE):
+        batch = obj_files[i:i + NM_BATCH_SIZE]
+        for obj in batch:
+            result[obj] = set()
+        output = subprocess.check_output(
+            [objdump_cmd, "-h"] + batch, universal_newlines=True
+        )
+        current = None
+        for line in output.splitlines():
+            match = re.match(r"^(\S.*):\s+file format", line)
+            if match:
+                current = result.get(match.group(1))
+                continue
+            match = re.match(r"^\s+\d+\s+(\S+)\s", line)
+            if match and current is not None:
+                current.add(match.group(1))
+    return result
+
+
+def has_keep_sections(sections, keep_patterns):
+    return any(
+        fnmatch.fnmatchcase(section, pattern)
+        for section in sections
+        for pattern in keep_patterns
+    )
+
+
+def load_index(index_path, config_hash):
+    if not isfile(index_path):
+        return None
+    try:
+        with open(index_path) as fp:
+            index = json.load(fp)
+    except ValueError:
+        return None
+    if (
+        index.get("version") != INDEX_VERSION
+        or index.get("config_hash") != config_hash
+    ):
+        return None
+    return index
+
+
+def save_index(index_path, index):
+    tmp_path = "%s.%d.tmp" % (index_path, os.getpid())
+    with open(tmp_path, "w") as fp:
+        json.dump(index, fp)
+    os.replace(tmp_path, index_path)
+
+
+def mark_pending(index_path, config_hash):
+    """Record that a link with a pruned set of sources has started.
+
+    The flag is cleared by `update_index` after a successful link, so if
+    the pruned link fails, the next build compiles all framework sources.
+    """
+    index = load_index(index_path, config_hash)
+    if index:
+        index["pending"] = True
+        save_index(index_path, index)
+
+
+def update_index(
+    index_path,
+    config_hash,
+    framework_dir,
+    build_dir,
+    src_files,
+    archives,
+    app_mtime,
+    keep_patterns,
+    nm_cmd,
+    objdump_cmd,
+):
+    """Refresh the symbol index with the objects produced by the last build"""
+    index = load_index(index_path, config_hash) or {
+        "version": INDEX_VERSION,
+        "config_hash": config_hash,
+        "sources": {},
+    }
+
+    framework_objs = {}
+    for f in src_files:
+        obj = get_object_path(build_dir, f)
+        if not isfile(obj):
+            continue
+        cached = index["sources"].get(f)
+        if cached and cached["obj_mtime"] == getmtime(obj):
+            continue
+        framework_objs[obj] = f
+
+    app_objs = []
+    known_objs = set(get_object_path(build_dir, f) for f in src_files)
+    for root, _, files in os.walk(build_dir):
+        if os.path.relpath(root, build_dir).startswith("FrameworkMbed"):
+            continue
+        for name in files:
+            path = join(root, name)
+            if name.endswith(".o") and path not in known_objs:
+                app_objs.append(path)
+
+    symbols = read_symbols(nm_cmd, list(framework_objs) + app_objs + archives)
+    sections = read_sections(objdump_cmd, list(framework_objs))
+    for obj, f in framework_objs.items():
+        entry = symbols[obj]
+        entry["keep"] = entry.pop("ctor") or has_keep_sections(
+            sections[obj], keep_patterns
+        )
+        entry["mtime"] = getmtime(join(framework_dir, f))
+        entry["obj_mtime"] = getmtime(obj)
+        index["sources"][f] = entry
+
+    app_undefined = set()
+    for obj in app_objs:
+        app_undefined.update(symbols[obj]["undefined"])
+    index["app"] = {"mtime": app_mtime, "undefined": sorted(app_undefined)}
+
+    # Prebuilt framework archives call back into framework sources
+    index["archives"] = {
+        path: {"mtime": getmtime(path), "undefined": symbols[path]["undefined"]}
+        for path in archives
+    }
+
+    index.pop("pending", None)
+    save_index(index_path, index)
+
+
+def select_sources(index, framework_dir, src_files, archives, extra_roots=None):
+    """Return sources reachable from the application, prebuilt archives,
+    startup code and RTOS.
+
+    Application references are taken from the last successful link, even if
+    the application was modified since. New references to pruned sources
+    fail the link, which leaves the index pending.
+
+    None is returned when the index cannot answer the question reliably
+    (missing or outdated entries, a failed pruned link), so the caller has
+    to compile everything.
+    """
+    if not index or index.get("pending") or "app" not in index:
+        return None
+
+    pending = set(index["app"]["undefined"])
+    for path in archives:
+        entry = index.get("archives", {}).get(path)
+        if not entry or entry["mtime"] != getmtime(path):
+            return None
+        pending.update(entry["undefined"])
+
+    sources = {}
+    for f in src_files:
+        entry = index["sources"].get(f)
+        if not entry or entry["mtime"] != getmtime(join(framework_dir, f)):
+            return None
+        sources[f] = entry
+
+    strong = {}
+    weak = {}
+    for f, entry in sources.items():
+        for s in entry["defined"]:
+            strong.setdefault(s, []).append(f)
+        for s in entry["weak"]:
+            weak.setdefault(s, []).append(f)
+
+    keep = set()
+    pending.update(ROOT_SYMBOLS)
+    pending.update(extra_roots or [])
+    queue = [
+        f
+        for f, entry in sources.items()
+        if f.split(os.path.sep)[0] in ROOT_FOLDERS
+        or f.endswith(".S")
+        or entry["keep"]
+    ]
+    resolved = set()
+
+    while queue or pending:
+        while queue:
+            f = queue.pop()
+            if f in keep:
+                continue
+            keep.add(f)
+            pending.update(sources[f]["undefined"])
+            # Weak definitions may be overridden by strong ones elsewhere
+            pending.update(sources[f]["weak"])
+        for s in pending - resolved:
+            queue.extend(strong.get(s) or weak.get(s) or [])
+        resolved.update(pending)
+        pending = set()
+
+    return [f for f in src_files if f in keep]
@@ -13,9 +13,11 @@
 # limitations under the License.
 
 import hashlib
+import json
 import sys
 import shutil
 import os
+import time
 import warnings
 
 from SCons.Script import COMMAND_LINE_TARGETS, DefaultEnvironment
@@ -51,7 +53,8 @@ sys.path.insert(
 )
 sys.path.insert(1, FRAMEWORK_DIR)
 
-from pio_mbed_adapter import PlatformioMbedAdapter
+import pio_mbed_daemon
+import pio_source_pruner
 
 
 # Long paths Windows hook
@@ -97,33 +100,132 @@ def get_build_profile(cpp_defines):
         return "develop"
 
 
-def _file_long_data(env, data):
+# Response files unused for this period are removed, in seconds
+RSP_FILE_MAX_AGE = 7 * 24 * 3600
+
+
+def _file_long_data(env, data, prefix="longinc"):
+    # Files are content-addressed and shared by all environments of the
+    # project, so identical flag sets are written only once
     tmp_file = os.path.join(
-        "$BUILD_DIR", "longinc-%s" % hashlib.md5(hashlib_encode_data(data)).hexdigest()
+        "$PROJECT_BUILD_DIR",
+        ".mbed-rsp",
+        "%s-%s" % (prefix, hashlib.md5(hashlib_encode_data(data)).hexdigest()),
     )
-    build_dir = env.subst("$BUILD_DIR")
-    if not os.path.isdir(build_dir):
-        os.makedirs(build_dir)
-    if os.path.isfile(env.subst(tmp_file)):
+    file_path = env.subst(tmp_file)
+    try:
+        # Marks the file as used, see cleanup_response_files()
+        os.utime(file_path, None)
         return tmp_file
-    with open(env.subst(tmp_file), "w") as fp:
+    except OSError:
+        # Doesn't exist yet or was just removed by a parallel build
+        pass
+    if not os.path.isdir(os.path.dirname(file_path)):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    # Parallel builds may write the same file, so it's replaced atomically
+    partial_path = "%s.%d.tmp" % (file_path, os.getpid())
+    with open(partial_path, "w") as fp:
         fp.write(data)
+    os.replace(partial_path, file_path)
     return tmp_file
 
 
-def long_incflags_hook(incflags):
+def cleanup_response_files():
+    # Files which weren't used by any environment for a while are removed,
+    # they are recreated on demand if an environment still needs them
+    rsp_dir = env.subst(os.path.join("$PROJECT_BUILD_DIR", ".mbed-rsp"))
+    if not os.path.isdir(rsp_dir):
+        return
+    expire_time = time.time() - RSP_FILE_MAX_AGE
+    for name in os.listdir(rsp_dir):
+        path = os.path.join(rsp_dir, name)
+        try:
+            if os.path.getmtime(path) < expire_time:
+                os.remove(path)
+        except OSError:
+            # Removed or refreshed by a parallel build
+            pass
+
+
+def _quote_rsp_arg(arg):
+    return '"%s"' % arg.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def response_file_hook(flags, prefix):
     return '@"%s"' % _file_long_data(
-        env, "\n".join(fs.to_unix_path(f) if WINDOWS else f for f in incflags)
+        env, "\n".join(_quote_rsp_arg(f) for f in flags), prefix
     )
 
 
-def get_inc_flags():
-    inc_paths = [
+def long_incflags_hook(incflags):
+    return response_file_hook(
+        [fs.to_unix_path(f) if WINDOWS else f for f in incflags], "longinc"
+    )
+
+
+def is_label_symbol(symbol):
+    return symbol.startswith(("TARGET_", "DEVICE_", "FEATURE_", "COMPONENT_"))
+
+
+def get_define_flags():
+    defines = configuration.get("build_symbols")
+    # IDE data and the "+" modes of Library Dependency Finder rely on CPPDEFINES
+    if env.IsIntegrationDump() or env.GetProjectOption(
+        "lib_ldf_mode", "chain"
+    ).endswith("+"):
+        return {"CPPDEFINES": defines}
+
+    # Label symbols stay in CPPDEFINES, PlatformIO checks them to apply
+    # "target_overrides" from "mbed_lib.json" of mbed libraries.
+    # Symbols are escaped for a shell, response files have their own quoting
+    return {
+        "CPPDEFINES": [s for s in defines if is_label_symbol(s)],
+        "CCFLAGS": [
+            response_file_hook(
+                [
+                    "-D" + s.replace('\\"', '"')
+                    for s in defines
+                    if not is_label_symbol(s)
+                ],
+                "longdef",
+            )
+        ],
+    }
+
+
+def get_link_flags():
+    lib_paths = [
+        p if os.path.isabs(p) else os.path.join(FRAMEWORK_DIR, p)
+        for p in configuration.get("lib_paths")
+    ]
+    link_flags = [
+        f
+        for f in configuration.get("build_flags").get("ld")
+        if f not in env.get("LINKFLAGS", [])
+    ]
+    if env.IsIntegrationDump():
+        return {"LIBPATH": lib_paths, "LINKFLAGS": link_flags}
+
+    return {
+        "LINKFLAGS": [
+            response_file_hook(
+                link_flags + ["-L" + p for p in lib_paths], "longlink"
+            )
+        ]
+    }
+
+
+def get_framework_inc_paths():
+    return [
         os.path.join(FRAMEWORK_DIR, d)
         for d in configuration.get("inc_dirs")
         if not os.path.isabs(d)
     ]
 
+
+def get_inc_flags():
+    inc_paths = get_framework_inc_paths()
+
     if env.IsIntegrationDump():
         return {"CPPPATH": inc_paths}
 
@@ -148,6 +250,200 @@ def get_inc_flags():
     return {"CCFLAGS": flags}
 
 
+def is_option_enabled(name):
+    return str(board.get(name, "no")).lower() in ("1", "yes", "true")
+
+
+def get_app_mtime():
+    return pio_source_pruner.get_newest_mtime(
+        [
+            env.subst(d)
+            for d in (
+                "$PROJECT_SRC_DIR",
+                "$PROJECT_INCLUDE_DIR",
+                "$PROJECT_LIB_DIR",
+                "$PROJECT_LIBDEPS_DIR",
+            )
+            if os.path.isdir(env.subst(d))
+        ]
+    )
+
+
+def get_framework_archives():
+    lib_paths = [
+        p if os.path.isabs(p) else os.path.join(FRAMEWORK_DIR, p)
+        for p in configuration.get("lib_paths")
+    ]
+    result = []
+    for lib in configuration.get("libs"):
+        for lib_path in lib_paths:
+            if os.path.isfile(os.path.join(lib_path, lib)):
+                result.append(os.path.join(lib_path, lib))
+                break
+    return result
+
+
+def get_source_ldscript():
+    if board.get("build.ldscript", ""):
+        return env.subst(board.get("build.ldscript"))
+    if board.get("build.mbed.ldscript", ""):
+        return env.subst(board.get("build.mbed.ldscript"))
+    return os.path.join(FRAMEWORK_DIR, configuration.get("ldscript", [])[0] or "")
+
+
+def prune_framework_sources(src_files):
+    # Only files reachable from the application, startup code and RTOS are
+    # compiled. The symbol index is collected from object files of previous
+    # builds and kept outside of $BUILD_DIR so it survives the "clean" target
+    index_path = env.subst(
+        os.path.join("$PROJECT_BUILD_DIR", "mbed-symbols-$PIOENV.json")
+    )
+    keep_patterns = pio_source_pruner.get_keep_patterns(get_source_ldscript())
+    config_hash = pio_source_pruner.get_config_hash(
+        configuration, adapter_params["target"], keep_patterns
+    )
+    archives = get_framework_archives()
+    app_mtime = get_app_mtime()
+
+    def _update_index(target, source, env):
+        pio_source_pruner.update_index(
+            index_path,
+            config_hash,
+            FRAMEWORK_DIR,
+            env.subst("$BUILD_DIR"),
+            src_files,
+            archives,
+            app_mtime,
+            keep_patterns,
+            env.WhereIs(env.subst("$CC").replace("gcc", "nm")),
+            env.WhereIs(env.subst("$CC").replace("gcc", "objdump")),
+        )
+
+    env.AddPostAction(
+        os.path.join("$BUILD_DIR", "${PROGNAME}.elf"),
+        env.VerboseAction(_update_index, "Updating mbed symbol index"),
+    )
+
+    index = pio_source_pruner.load_index(index_path, config_hash)
+    selected = pio_source_pruner.select_sources(
+        index,
+        FRAMEWORK_DIR,
+        src_files,
+        archives,
+        pio_source_pruner.get_wrapped_symbols(
+            configuration.get("build_flags").get("ld", [])
+        ),
+    )
+    if selected is None:
+        print("Symbol index is outdated, all framework sources will be compiled")
+        return src_files
+
+    def _mark_pending(target, source, env):
+        pio_source_pruner.mark_pending(index_path, config_hash)
+
+    # Set only when the linker really runs, until the pruned link succeeds
+    # the next build falls back to all sources
+    env.AddPreAction(
+        os.path.join("$BUILD_DIR", "${PROGNAME}.elf"),
+        env.VerboseAction(_mark_pending, "Marking mbed symbol index as pending"),
+    )
+
+    if index["app"]["mtime"] < app_mtime:
+        print(
+            "Application was modified since the symbol index was updated. "
+            "If linking fails with undefined references, the next build "
+            "compiles all framework sources"
+        )
+    excluded = sorted(set(src_files) - set(selected))
+    report_file = env.subst(os.path.join("$BUILD_DIR", "mbed_pruned_sources.txt"))
+    with open(report_file, "w") as fp:
+        fp.write("\n".join(excluded))
+    print(
+        "Excluded %d of %d framework sources unreachable from the application "
+        "(see %s)" % (len(excluded), len(src_files), report_file)
+    )
+    return selected
+
+
+def get_configuration_cache_key():
+    # Any change in builder options or configuration files invalidates
+    # the cached result of the mbed build API
+    data = [adapter_params]
+    for path in [os.path.join(FRAMEWORK_DIR, "package.json")] + [
+        os.path.join(env.subst("$PROJECT_DIR"), f)
+        for f in pio_mbed_daemon.PROJECT_FILES
+    ]:
+        data.append(os.path.getmtime(path) if os.path.isfile(path) else None)
+    return hashlib.md5(
+        hashlib_encode_data(json.dumps(data, sort_keys=True))
+    ).hexdigest()
+
+
+def load_cached_configuration():
+    cache_file = env.subst(os.path.join("$BUILD_DIR", "mbed-configuration.json"))
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with open(cache_file) as fp:
+            data = json.load(fp)
+    except ValueError:
+        return None
+    if data.get("key") != get_configuration_cache_key():
+        return None
+    return data["configuration"]
+
+
+def save_cached_configuration(configuration):
+    cache_file = env.subst(os.path.join("$BUILD_DIR", "mbed-configuration.json"))
+    tmp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+    with open(tmp_file, "w") as fp:
+        json.dump(
+            {"key": get_configuration_cache_key(), "configuration": configuration},
+            fp,
+        )
+    os.replace(tmp_file, cache_file)
+
+
+def dump_compile_commands():
+    # Compilation database for framework sources, so IDE indexers don't need
+    # to wait for the build system to produce one
+    build_flags = configuration.get("build_flags")
+    common_args = (
+        build_flags.get("common", [])
+        + ["-include", "mbed_config.h"]
+        + ["-D" + s.replace('\\"', '"') for s in configuration.get("build_symbols")]
+        + [
+            "-I" + p
+            for p in [
+                FRAMEWORK_DIR,
+                env.subst("$BUILD_DIR"),
+                env.subst("$PROJECT_SRC_DIR"),
+            ]
+            + get_framework_inc_paths()
+        ]
+    )
+    commands = []
+    for f in configuration.get("src_files"):
+        if f.endswith(".cpp"):
+            args = [env.subst("$CXX")] + build_flags.get("cxx", []) + common_args
+        elif f.endswith(".c"):
+            args = [env.subst("$CC")] + build_flags.get("c", []) + common_args
+        else:
+            args = [env.subst("$CC")] + build_flags.get("asm", []) + common_args
+        commands.append(
+            {
+                "directory": FRAMEWORK_DIR,
+                "file": os.path.join(FRAMEWORK_DIR, f),
+                "arguments": args + ["-c", os.path.join(FRAMEWORK_DIR, f)],
+            }
+        )
+
+    with open(
+        env.subst(os.path.join("$BUILD_DIR", "compile_commands_mbed.json")), "w"
+    ) as fp:
+        json.dump(commands, fp, indent=2)
+
+
 #
 # Print warnings about deprecated flags
 #
@@ -184,19 +480,51 @@ if not os.path.isfile(app_config):
 
 build_profile = get_build_profile(cpp_defines)
 
-framework_processor = PlatformioMbedAdapter(
-    [os.path.join(FRAMEWORK_DIR, f) for f in src_folders],
-    env.subst("$BUILD_DIR"),
-    get_mbed_target(env.subst("$BOARD")),
-    FRAMEWORK_DIR,
-    app_config,
-    build_profile,
-    env.subst("$PROJECT_DIR"),
+adapter_params = dict(
+    src_paths=[os.path.join(FRAMEWORK_DIR, f) for f in src_folders],
+    build_path=env.subst("$BUILD_DIR"),
+    target=get_mbed_target(env.subst("$BOARD")),
+    framework_path=FRAMEWORK_DIR,
+    app_config=app_config,
+    build_profile=build_profile,
+    custom_target_path=env.subst("$PROJECT_DIR"),
+    project_dir=env.subst("$PROJECT_DIR"),
 )
 
+_framework_processor = None
+
+
+def get_framework_processor():
+    # The mbed build API is imported only when it's really needed, e.g. when
+    # the configuration daemon is not running
+    global _framework_processor
+    if _framework_processor is None:
+        from pio_mbed_adapter import PlatformioMbedAdapter
+
+        _framework_processor = PlatformioMbedAdapter(**adapter_params)
+    return _framework_processor
+
+
 try:
     print("Collecting mbed sources...")
-    configuration = framework_processor.extract_project_info(generate_config=True)
+    # IDE reloads need only flags and paths, so the configuration from the
+    # previous run is reused and mbed_config.h is not generated again.
+    # Otherwise (never built project or modified configuration) the header
+    # has to match the extracted configuration
+    configuration = None
+    if env.IsIntegrationDump() and os.path.isfile(
+        env.subst(os.path.join("$BUILD_DIR", "mbed_config.h"))
+    ):
+        configuration = load_cached_configuration()
+    if configuration is None:
+        configuration = pio_mbed_daemon.request_project_info(
+            FRAMEWORK_DIR, adapter_params, generate_config=True
+        )
+        if configuration is None:
+            configuration = get_framework_processor().extract_project_info(
+                generate_config=True
+            )
+        save_cached_configuration(configuration)
 except Exception as exc:
     sys.stderr.write("mbed build API internal error\n")
     print(exc)
@@ -212,25 +540,28 @@ env.AppendUnique(
     ASFLAGS=configuration.get("build_flags").get("asm"),
     CFLAGS=configuration.get("build_flags").get("c"),
     CCFLAGS=["-includembed_config.h"] + configuration.get("build_flags").get("common"),
-    CPPDEFINES=configuration.get("build_symbols"),
     CPPPATH=[FRAMEWORK_DIR, "$BUILD_DIR", "$PROJECTSRC_DIR"],
     CXXFLAGS=configuration.get("build_flags").get("cxx"),
-    LINKFLAGS=configuration.get("build_flags").get("ld"),
     LIBS=configuration.get("libs") + configuration.get("syslibs"),
 )
 
+# Framework defines, include paths and linker inputs are long lists, they are
+# moved to response files to keep command lines and their signatures short
+cleanup_response_files()
+env.Append(**get_define_flags())
+env.Append(**get_link_flags())
+
 # Note: this line should be called before appending CCFLAGS to ASFLAGS
 env.Append(**get_inc_flags())
 
 env.Append(
     ASFLAGS=env.get("CCFLAGS", [])[:],
-    LIBPATH=[
-        p if os.path.isabs(p) else os.path.join(FRAMEWORK_DIR, p)
-        for p in configuration.get("lib_paths")
-    ],
     LIBS=["c", "gcc"],  # Fixes linker issues in some cases
 )
 
+if env.IsIntegrationDump():
+    dump_compile_commands()
+
 if "nordicnrf5" in env.get("PIOPLATFORM"):
     has_soft_device = len(configuration.get("hex")) > 0
     if has_soft_device:
@@ -273,13 +604,20 @@ if not board.get("build.ldscript", ""):
 # Compile core part
 #
 
+src_files = configuration.get("src_files")
+if env.IsIntegrationDump():
+    # Nothing is compiled while dumping IDE data
+    src_files = []
+elif is_option_enabled("build.mbed.prune_sources"):
+    src_files = prune_framework_sources(src_files)
+
 lib_sources = dict()
 
-for f in configuration.get("src_files"):
-    lib_name = f.split(os.path.sep)[0]
+for f in src_files:
+    lib_name, _, lib_path = f.partition(os.path.sep)
     if lib_name not in lib_sources:
         lib_sources[lib_name] = ["-<*>"]
-    lib_sources[lib_name].append("+<%s>" % "/".join(f.split(os.path.sep)[1:]))
+    lib_sources[lib_name].append("+<%s>" % lib_path.replace(os.path.sep, "/"))
 
 
 for lib_name, src_filter in lib_sources.items():
@@ -295,6 +633,12 @@ for lib_name, src_filter in lib_sources.items():
 
 
 def merge_firmwares(target, source, env):
+    framework_processor = get_framework_processor()
+    if framework_processor.toolchain is None:
+        # The configuration was provided by the daemon, region and hook data
+        # are not transferred, so the build API runs in-process here
+        framework_processor.extract_project_info()
+
     framework_processor.merge_apps(env.subst(source)[0], env.subst(target)[0])
 
     # some boards (e.g. nrf51 modify the resulting firmware)
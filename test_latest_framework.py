@@ -12,12 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import argparse
+import hashlib
+import os
 import subprocess
 import sys
 
 from os import listdir, makedirs
-from os.path import expanduser, isdir, isfile, join, normpath
-from shutil import move, copy2
+from os.path import abspath, expanduser, isdir, isfile, join, normpath, relpath
+from shutil import copy2, move, rmtree
 
 PYTHON_EXE = normpath(sys.executable)
 
@@ -28,18 +31,123 @@ PIO_PACKAGES_ROOT = join(expanduser("~"), ".platformio", "packages")
 PIO_MBED_PACKAGE_ROOT = join(PIO_PACKAGES_ROOT, "framework-mbed")
 LATEST_MBED_PACKAGE_ROOT = join(PIO_PACKAGES_ROOT, "framework-mbed-latest")
 
+CACHE_ROOT = join(expanduser("~"), ".platformio", ".cache", "framework-mbed")
+
+# Folders used by the builder, keep in sync with "src_folders"
+# in platformio-build.py
+SPARSE_FOLDERS = (
+    "cmsis",
+    "connectivity",
+    "drivers",
+    "events",
+    "features",
+    "hal",
+    "platform",
+    "rtos",
+    "storage",
+    "targets",
+    "tools",
+)
+
 
 def exec_cmd(*args, **kwargs):
     print(" ".join(args[0]))
     return subprocess.call(*args, **kwargs)
 
 
-def clone_latest_mbed_release():
-    print ("Cloning the latest framework release ...")
-    exec_cmd([
-        "git", "clone", MBED_REPOSITORY,
-        "--branch", MBED_VERSION, LATEST_MBED_PACKAGE_ROOT
-    ])
+def get_mirror_path(cache_root):
+    return join(cache_root, "mirror.git")
+
+
+def get_checkout_path(cache_root, commit, sparse):
+    return join(cache_root, "checkouts", commit + ("" if sparse else "-full"))
+
+
+def resolve_commit(mirror, version):
+    # Refs like "latest" move between releases, so checkouts are
+    # cached per commit
+    return subprocess.check_output(
+        ["git", "-C", mirror, "rev-parse", "--verify", "%s^{commit}" % version],
+        universal_newlines=True,
+    ).strip()
+
+
+def update_mirror(cache_root, repository, offline=False):
+    """Keep a bare mirror of the repository, so new versions are fetched
+    incrementally and already known ones are available offline"""
+    mirror = get_mirror_path(cache_root)
+    if not isdir(mirror):
+        assert not offline, "There is no local mirror of %s" % repository
+        print("Creating a mirror of %s ..." % repository)
+        makedirs(cache_root, exist_ok=True)
+        exec_cmd(["git", "clone", "--mirror", repository, mirror])
+        # Allows partial clones of the mirror in checkout_framework()
+        exec_cmd(["git", "-C", mirror, "config", "uploadpack.allowFilter", "true"])
+    elif not offline:
+        print("Updating the mirror ...")
+        if exec_cmd(["git", "-C", mirror, "remote", "update", "--prune"]) != 0:
+            print("Warning! Could not update the mirror, using cached data")
+
+    assert isdir(mirror)
+    return mirror
+
+
+def checkout_framework(cache_root, mirror, version, sparse=True):
+    commit = resolve_commit(mirror, version)
+    checkout = get_checkout_path(cache_root, commit, sparse)
+    if isdir(checkout):
+        print("Using cached checkout of %s (%s)" % (version, commit))
+        return checkout
+
+    print("Checking out %s ..." % version)
+    tmp_checkout = "%s.%d.tmp" % (checkout, os.getpid())
+    # "--depth" is ignored for local paths, so the mirror is
+    # referenced via the file:// protocol
+    cmd = [
+        "git", "clone", "--depth", "1", "--branch", version,
+        "file://" + abspath(mirror).replace(os.sep, "/"), tmp_checkout
+    ]
+    if sparse:
+        cmd[2:2] = ["--filter=blob:none", "--sparse"]
+    assert exec_cmd(cmd) == 0, "Could not check out %s" % version
+    if sparse:
+        assert exec_cmd(
+            ["git", "-C", tmp_checkout, "sparse-checkout", "set", "--cone"]
+            + list(SPARSE_FOLDERS)
+        ) == 0
+    os.rename(tmp_checkout, checkout)
+
+    return checkout
+
+
+def link_tree(src, dst):
+    """Materialize the tree using hard links, falling back to copying when
+    the cache and the packages are located on different drives"""
+    if isdir(dst):
+        rmtree(dst)
+    for root, dirs, files in os.walk(src):
+        if ".git" in dirs:
+            dirs.remove(".git")
+        target_dir = join(dst, relpath(root, src))
+        makedirs(target_dir, exist_ok=True)
+        for name in files:
+            try:
+                os.link(join(root, name), join(target_dir, name))
+            except OSError:
+                copy2(join(root, name), join(target_dir, name))
+
+
+def clone_latest_mbed_release(
+    repository=MBED_REPOSITORY,
+    version=MBED_VERSION,
+    cache_root=CACHE_ROOT,
+    sparse=True,
+    offline=False,
+):
+    print ("Provisioning the framework release %s ..." % version)
+    mirror = update_mirror(cache_root, repository, offline)
+    checkout = checkout_framework(cache_root, mirror, version, sparse)
+    link_tree(checkout, LATEST_MBED_PACKAGE_ROOT)
 
     assert isdir(LATEST_MBED_PACKAGE_ROOT)
 
@@ -66,21 +174,79 @@ def copy_pio_tools():
     assert isfile(join(tools_path, "platformio-build.py"))
 
 
-def build_deps():
-    print ("Building package dependencies ...")
+def get_deps_cache_path(cache_root):
+    # Dependencies are pinned in install_python_deps.py, so its contents
+    # and the interpreter version identify the resulting packages
+    with open("install_python_deps.py", "rb") as fp:
+        digest = hashlib.md5(fp.read()).hexdigest()
+    return join(
+        cache_root,
+        "package_deps",
+        "%s-py%d.%d" % (digest, sys.version_info.major, sys.version_info.minor),
+    )
+
+
+def build_deps(cache_root=CACHE_ROOT):
+    deps_path = join(LATEST_MBED_PACKAGE_ROOT, "platformio", "package_deps")
+    cached_deps = get_deps_cache_path(cache_root)
+    if not isdir(cached_deps):
+        print ("Building package dependencies ...")
+        exec_cmd([
+            PYTHON_EXE, join(
+                LATEST_MBED_PACKAGE_ROOT, "platformio", "install_python_deps.py")
+        ])
+        assert isdir(deps_path)
+        link_tree(deps_path, cached_deps)
+    else:
+        print ("Using cached package dependencies ...")
+        link_tree(cached_deps, deps_path)
+
+    assert isdir(deps_path)
+
+
+def build_source_manifest():
+    print ("Building source manifest ...")
     exec_cmd([
         PYTHON_EXE, join(
-            LATEST_MBED_PACKAGE_ROOT, "platformio", "install_python_deps.py")
+            LATEST_MBED_PACKAGE_ROOT, "platformio", "build_source_manifest.py")
     ])
 
-    assert isdir(join(LATEST_MBED_PACKAGE_ROOT, "platformio", "package_deps"))
+    assert isfile(
+        join(LATEST_MBED_PACKAGE_ROOT, "platformio", "source_manifest.json.gz"))
 
 
-def switch_to_latest_framework():
-    clone_latest_mbed_release()
+def switch_to_latest_framework(**kwargs):
+    cache_root = kwargs.get("cache_root", CACHE_ROOT)
+    clone_latest_mbed_release(**kwargs)
     move_package_file()
     copy_pio_tools()
-    build_deps()
+    build_deps(cache_root)
+    build_source_manifest()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Provision a framework release into %s"
+        % LATEST_MBED_PACKAGE_ROOT
+    )
+    parser.add_argument("--repository", default=MBED_REPOSITORY)
+    parser.add_argument("--version", default=MBED_VERSION,
+                        help="branch or tag to check out")
+    parser.add_argument("--cache-dir", default=CACHE_ROOT)
+    parser.add_argument("--full", action="store_true",
+                        help="check out all folders of the repository")
+    parser.add_argument("--offline", action="store_true",
+                        help="use the local mirror without fetching")
+    args = parser.parse_args()
+
+    switch_to_latest_framework(
+        repository=args.repository,
+        version=args.version,
+        cache_root=args.cache_dir,
+        sparse=not args.full,
+        offline=args.offline,
+    )
 
 
-switch_to_latest_framework()
+if __name__ == "__main__":
+    main()